@@ -1,21 +1,28 @@
 import sys
 import datetime
+import functools
 import csv
 import toml
 import json
-import tempfile
+import orjson
 import os
+import re
 import time
-import requests
-from decimal import Decimal
-import dataclasses
-from dataclasses import dataclass
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import NamedTuple
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 config = toml.load("config.toml")
 columns = config["csv"]["columns"]
 
 
-@dataclass
+@dataclass(slots=True)
 class Payment:
     date: datetime.date
     payee: str
@@ -25,14 +32,19 @@ class Payment:
     category: str | None
 
     def to_json(self) -> dict:
-        d = dataclasses.asdict(self)
-        d["date"] = str(d["date"])
-        return d
+        return {
+            "date": self.date.isoformat(),
+            "payee": self.payee,
+            "payee_friendly": self.payee_friendly,
+            "reference": self.reference,
+            "amount": self.amount,
+            "category": self.category,
+        }
 
     @staticmethod
     def from_json(obj: dict):
         return Payment(
-            date=datetime.datetime.strptime(obj["date"], "%Y-%m-%d").date(),
+            date=datetime.date.fromisoformat(obj["date"]),
             payee=obj["payee"],
             payee_friendly=obj["payee_friendly"],
             reference=obj["reference"],
@@ -41,146 +53,405 @@ class Payment:
         )
 
 
-payments = []
-
-with open(sys.argv[1]) as csvfile:
-    reader = csv.DictReader(csvfile, delimiter=";")
-    for row in reader:
-        date = datetime.datetime.strptime(row[columns["date"]], "%d.%m.%Y").date()
-        # replace commas with dots
-        # parse the number using Decimal to not loose any data through double precision
-        # take it times 100 to get to the cents
-        # invert it for cospend and convert it to an int
-        amount = int(-(Decimal(row[columns["amount"]].replace(",", ".")) * 100))
-
-        payments.append(
-            Payment(
-                date=date,
-                payee=row[columns["payee"]],
-                payee_friendly=row[columns["payee"]],
-                reference=row[columns["reference"]],
-                amount=amount,
-                category=None,
+# everything but the payment itself is the same for every bill
+@dataclass(frozen=True, slots=True)
+class CospendConfig:
+    bill_url: str
+    username: str
+    password: str
+    payed_for: str
+    payer: int
+    category_mapping: dict[str, int]
+    concurrency: int  # number of bills created at the same time
+
+    @staticmethod
+    def from_config(obj: dict):
+        concurrency = int(obj.get("concurrency", 8))
+        if concurrency < 1:
+            raise ValueError(
+                f"cospend.concurrency must be at least 1, got {concurrency}"
             )
+        return CospendConfig(
+            bill_url=f"{obj['domain']}/index.php/apps/cospend/api-priv/projects/{obj['project_name']}/bills",
+            username=obj["username"],
+            password=obj["password"],
+            payed_for=obj["payed_for"],
+            payer=int(obj["payer"]),
+            category_mapping=obj["category_mapping"],
+            concurrency=concurrency,
         )
 
 
-results: dict[str, list[Payment]] = {
-    "approved": [],
-    "second_look": [],
-    "ignore": [],
-}
+# read when starting, so a broken config fails before classifying
+COSPEND = CospendConfig.from_config(config["cospend"])
 
-items = list(reversed(payments))
-exit_loop = False
-for idx, payment in enumerate(items):
-    if exit_loop:
-        break
-    print()
-    print()
-    for rule in config["naming"]["rule"]:
-        if not rule.get("payee_contains") is None:
-            if rule.get("payee_contains").lower() in payment.payee.lower():
-                print(rule)
-                payment = dataclasses.replace(
-                    payment,
-                    payee_friendly=rule["result"].get("name", payment.payee),
-                    category=rule["result"].get("category", payment.category),
-                )
-        if not rule.get("reference_contains") is None:
-            if rule.get("reference_contains").lower() in payment.payee.lower():
-                print(rule)
-                payment = dataclasses.replace(
-                    payment,
-                    payee_friendly=rule["result"].get("name", payment.payee),
-                    category=rule["result"].get("category", payment.category),
-                )
 
-    print(f"{idx+1}/{len(payments)}")
-    print(f"Date:       {payment.date.isoformat()}")
-    print(f"Payee:      {payment.payee_friendly} ({payment.payee})")
-    print(f"Reference:  {payment.reference}")
-    print(f"Amount:     {payment.amount/100:.2f} €")
+class Rule(NamedTuple):
+    index: int  # position in config["naming"]["rule"]
+    field: str
+    needle: str
+    name: str | None
+    category: str | None
+    terminal: bool  # stop applying further rules once this one matched
+
 
-    while True:
-        print(
-            "(a) approved / (c) add category / (e) edit by hand and approve / (j) second look / (x) ignore / (q) quit"
+# precompile the naming rules once, so classifying a payment does not have to walk
+# the config for every rule again
+def compile_rules(rule_field: str) -> tuple[Rule, ...]:
+    return tuple(
+        Rule(
+            index=idx,
+            field=rule_field,
+            needle=rule[f"{rule_field}_contains"].lower(),
+            name=rule["result"].get("name"),
+            category=rule["result"].get("category"),
+            terminal=rule["result"].get("terminal", False),
         )
-        entered = input()
-        if entered == "a":
-            results["approved"].append(payment)
-            print("added to the approved list")
-            break
-        if entered == "c":
-            print("(g) grocery")
-            print("(s) shopping")
-            print("(x) dont change")
-            categories = {
-                "g": "grocery",
-                "s": "shopping",
-            }
-            payment.category = categories.get(input())
-        elif entered == "e":
-            with tempfile.NamedTemporaryFile("w", delete=False) as tmpF:
-                js = json.dump(payment.to_json(), tmpF, indent=2)
-                path = tmpF.name
-            os.system("%s %s" % (os.getenv("EDITOR"), path))
-            with open(path) as tmpF:
-                payment = Payment.from_json(json.load(tmpF))
-            results["approved"].append(payment)
-            print("added to the approved list")
-            break
-        elif entered == "j":
-            results["second_look"].append(payment)
-            print("added to the second look list")
-            break
-        elif entered == "x":
-            results["ignore"].append(payment)
-            print("added to the ignore list")
+        for idx, rule in enumerate(config["naming"]["rule"])
+        if rule.get(f"{rule_field}_contains") is not None
+    )
+
+
+RULES_PAYEE = compile_rules("payee")
+RULES_REF = compile_rules("reference")
+HAS_RULES = bool(RULES_PAYEE or RULES_REF)
+
+
+# with pyahocorasick installed, the rules of a field are matched in a single pass
+def build_automaton(rules: tuple[Rule, ...]):
+    if ahocorasick is None or not rules:
+        return None
+    automaton = ahocorasick.Automaton()
+    for rule in rules:
+        # pyahocorasick refuses empty words, those rules always match anyway
+        if rule.needle:
+            automaton.add_word(rule.needle, automaton.get(rule.needle, ()) + (rule,))
+    automaton.make_automaton()
+    return automaton
+
+
+AUTOMATON_PAYEE = build_automaton(RULES_PAYEE)
+AUTOMATON_REF = build_automaton(RULES_REF)
+ALWAYS_PAYEE = tuple(rule for rule in RULES_PAYEE if not rule.needle)
+ALWAYS_REF = tuple(rule for rule in RULES_REF if not rule.needle)
+
+
+def match_rules(
+    rules: tuple[Rule, ...], automaton, always: tuple[Rule, ...], haystack: str
+) -> Iterable[Rule]:
+    if automaton is None:
+        return [rule for rule in rules if rule.needle in haystack]
+    hits = set(always)
+    # an automaton without any words can't be iterated
+    if len(automaton):
+        hits.update(rule for _, found in automaton.iter(haystack) for rule in found)
+    return hits
+
+
+def simplify_payment(payment: Payment):
+    hits = [
+        *match_rules(RULES_PAYEE, AUTOMATON_PAYEE, ALWAYS_PAYEE, payment.payee.lower()),
+        *match_rules(RULES_REF, AUTOMATON_REF, ALWAYS_REF, payment.reference.lower()),
+    ]
+    # apply the matches in the order the rules were declared in,
+    # the payee part of a rule before its reference part
+    for rule in sorted(hits, key=lambda rule: (rule.index, rule.field != "payee")):
+        print(config["naming"]["rule"][rule.index])
+        payment.payee_friendly = rule.name or payment.payee
+        payment.category = rule.category or payment.category
+        if rule.terminal:
             break
-        elif entered == "q":
-            results["second_look"].extend(items[idx:])
-            print("adding all remaining items to second look list")
-            exit_loop = True
+
+
+@functools.cache
+def parse_date(s: str) -> datetime.date:
+    # bank exports contain many payments per day, so every date is only parsed once
+    return datetime.datetime.strptime(s, "%d.%m.%Y").date()
+
+
+THOUSANDS_GROUPING = re.compile(r"[+-]?\d{1,3}(\.\d{3})+,\d*")
+
+
+def is_digits(s: str) -> bool:
+    return s.isascii() and s.isdigit()
+
+
+def parse_cents(value: str) -> int:
+    # parse euros and cents as two integers to not loose any data through double precision
+    s = value.strip()
+    if "," in s:
+        # a comma is the decimal separator, so dots can only be thousands separators
+        if "." in s and not THOUSANDS_GROUPING.fullmatch(s):
+            raise ValueError(f"invalid amount: {value!r}")
+        s = s.replace(".", "").replace(",", ".")
+    negative = s.startswith("-")
+    if s.startswith(("+", "-")):
+        s = s[1:]
+    euros, separator, cents = s.partition(".")
+    # either part may be left out, like ",5" or "1,", but not both
+    if not (euros or cents) or not all(
+        part == "" or is_digits(part) for part in (euros, cents)
+    ):
+        raise ValueError(f"invalid amount: {value!r}")
+    amount = int(euros or "0") * 100 + int((cents + "00")[:2])
+    # invert it for cospend
+    return amount if negative else -amount
+
+
+def csv_to_payment(path: str) -> list[Payment]:
+    with open(path) as csvfile:
+        reader = csv.reader(csvfile, delimiter=";")
+        header = next(reader)
+        date_col, payee_col, reference_col, amount_col = (
+            header.index(columns[key])
+            for key in ("date", "payee", "reference", "amount")
+        )
+        try:
+            return [
+                Payment(
+                    date=parse_date(row[date_col]),
+                    payee=row[payee_col],
+                    payee_friendly=row[payee_col],
+                    reference=row[reference_col],
+                    amount=parse_cents(row[amount_col]),
+                    category=None,
+                )
+                for row in reader
+                if row
+            ]
+        except ValueError as e:
+            # point to the row that could not be parsed
+            raise ValueError(f"{path}, line {reader.line_num}: {e}") from e
+
+
+payments = csv_to_payment(sys.argv[1])
+
+
+MENU = "(a) approved / (c) add category / (e) edit by hand and approve / (j) second look / (x) ignore / (q) quit\n"
+CATEGORY_MENU = "(g) grocery\n(s) shopping\n(x) dont change\n"
+
+
+def read_input() -> str:
+    line = sys.stdin.readline()
+    # treat the end of piped input like quitting instead of prompting forever
+    return line.rstrip("\r\n") if line else "q"
+
+
+CATEGORIES = {
+    "g": "grocery",
+    "s": "shopping",
+}
+
+
+@dataclass(slots=True)
+class ClassifyState:
+    approved: list[Payment] = field(default_factory=list)
+    second_look: list[Payment] = field(default_factory=list)
+    ignore: list[Payment] = field(default_factory=list)
+    idx: int = 0
+    exit_loop: bool = False
+    edit_path: str | None = None  # reused for every edit of this session
+
+
+# every handler returns whether the current payment is done
+def handle_approve(payment: Payment, state: ClassifyState) -> bool:
+    state.approved.append(payment)
+    print("added to the approved list")
+    return True
+
+
+def handle_category(payment: Payment, state: ClassifyState) -> bool:
+    sys.stdout.write(CATEGORY_MENU)
+    payment.category = CATEGORIES.get(read_input())
+    return False
+
+
+def handle_edit(payment: Payment, state: ClassifyState) -> bool:
+    # only needed for editing, so they are not imported on every start
+    import shlex
+    import subprocess
+    import tempfile
+
+    editor = os.environ.get("EDITOR")
+    if not editor:
+        print("EDITOR is not set, can't edit by hand")
+        return False
+    if state.edit_path is None:
+        fd, state.edit_path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+    with open(state.edit_path, "w") as tmpF:
+        json.dump(payment.to_json(), tmpF, indent=2)
+    # run the editor directly instead of through a shell
+    try:
+        subprocess.run([*shlex.split(editor), state.edit_path], check=True)
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        print("editing failed, payment not changed:", e)
+        return False
+    try:
+        with open(state.edit_path) as tmpF:
+            obj = json.load(tmpF)
+        if not isinstance(obj, dict):
+            raise ValueError("expected a JSON object")
+        payment = Payment.from_json(obj)
+    except (ValueError, KeyError, TypeError) as e:
+        print("could not read the edited payment, payment not changed:", e)
+        return False
+    state.approved.append(payment)
+    print("added to the approved list")
+    return True
+
+
+def handle_second_look(payment: Payment, state: ClassifyState) -> bool:
+    state.second_look.append(payment)
+    print("added to the second look list")
+    return True
+
+
+def handle_ignore(payment: Payment, state: ClassifyState) -> bool:
+    state.ignore.append(payment)
+    print("added to the ignore list")
+    return True
+
+
+def handle_quit(payment: Payment, state: ClassifyState) -> bool:
+    state.second_look.extend(reversed(payments[: len(payments) - state.idx]))
+    print("adding all remaining items to second look list")
+    state.exit_loop = True
+    return True
+
+
+def handle_unknown(payment: Payment, state: ClassifyState) -> bool:
+    return False
+
+
+HANDLERS = {
+    "a": handle_approve,
+    "c": handle_category,
+    "e": handle_edit,
+    "j": handle_second_look,
+    "x": handle_ignore,
+    "q": handle_quit,
+}
+
+# every prompt ends with a newline, so line buffering flushes each one exactly once
+sys.stdout.reconfigure(line_buffering=True)
+state = ClassifyState()
+try:
+    # the bank lists the newest payment first, so walk the payments backwards
+    for idx in range(len(payments)):
+        if state.exit_loop:
             break
+        state.idx = idx
+        payment = payments[-1 - idx]
+        sys.stdout.write("\n\n")
+        if HAS_RULES:
+            simplify_payment(payment)
+
+        # write the whole prompt at once instead of line by line
+        sys.stdout.write(
+            f"{idx+1}/{len(payments)}\n"
+            f"Date:       {payment.date.isoformat()}\n"
+            f"Payee:      {payment.payee_friendly} ({payment.payee})\n"
+            f"Reference:  {payment.reference}\n"
+            f"Amount:     {payment.amount/100:.2f} €\n"
+        )
+
+        while True:
+            sys.stdout.write(MENU)
+            if HANDLERS.get(read_input(), handle_unknown)(payment, state):
+                break
+finally:
+    if state.edit_path is not None:
+        os.unlink(state.edit_path)
 
 
 # let's persist all lists first
-def persist(items: list[Payment], path: str):
+def persist(items: Iterable[Payment], path: str):
     print("dumping to ", path)
-    with open(path, "w") as fh:
-        json.dump([x.to_json() for x in items], fh, indent=2)
+    # write one payment per line, so the whole list never has to be encoded at once
+    # orjson serializes the Payment dataclasses and their dates natively
+    with open(path, "wb") as fh:
+        fh.write(b"[")
+        separator = b"\n  "
+        for item in items:
+            fh.write(separator)
+            fh.write(orjson.dumps(item))
+            separator = b",\n  "
+        fh.write(b"\n]\n")
     print("done")
 
 
-persist(results["approved"], f"{datetime.datetime.now().isoformat()}-approved.json")
-persist(
-    results["second_look"], f"{datetime.datetime.now().isoformat()}-second_look.json"
-)
-persist(results["ignore"], f"{datetime.datetime.now().isoformat()}-ignore.json")
+# use the same timestamp for all lists, so the files of one run belong together
+stamp = datetime.datetime.now().isoformat()
+persist(state.approved, f"{stamp}-approved.json")
+persist(state.second_look, f"{stamp}-second_look.json")
+persist(state.ignore, f"{stamp}-ignore.json")
+
+
+# share one session, so all bills are created over pooled keep-alive connections
+# requests is only imported once there are bills to create
+@functools.cache
+def get_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    session.auth = (COSPEND.username, COSPEND.password)
+    # keep a connection around for every worker sending bills
+    adapter = HTTPAdapter(pool_maxsize=COSPEND.concurrency)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@functools.cache
+def date_to_timestamp(date: datetime.date) -> float:
+    # local midnight of the date; the timezone lookup is only done once per day
+    return datetime.datetime.combine(date, datetime.datetime.min.time()).timestamp()
 
 
 def create_bill(payment: Payment):
-    response = requests.post(
-        f"{config['cospend']['domain']}/index.php/apps/cospend/api-priv/projects/{config['cospend']['project_name']}/bills",
-        auth=(config["cospend"]["username"], config["cospend"]["password"]),
+    return get_session().post(
+        COSPEND.bill_url,
         json={
             "amount": payment.amount / 100,
             "what": payment.payee_friendly,
-            "category": config["cospend"]["category_mapping"].get(payment.category, 0),
+            "category": COSPEND.category_mapping.get(payment.category, 0),
             "comment": payment.reference,
-            "payed_for": config["cospend"]["payed_for"],
-            "payer": int(config["cospend"]["payer"]),
+            "payed_for": COSPEND.payed_for,
+            "payer": COSPEND.payer,
             "paymentmodeid": 0,  # TODO: always use transfer / move to config.toml
             "repeat": "n",
-            "timestamp": datetime.datetime.combine(
-                payment.date, datetime.datetime.min.time()
-            ).timestamp(),
+            "timestamp": date_to_timestamp(payment.date),
         },
     )
-    print(response.status_code, response.text)
 
 
-for payment in results["approved"]:
-    print("create_bill", payment.payee)
-    create_bill(payment)
+# the bills are independent of each other, so send them concurrently,
+# bounded by the configured concurrency to not overload the server
+if state.approved:
+    import requests
+
+    # set up the session before the workers race to create it
+    get_session()
+    failed = []
+    with ThreadPoolExecutor(max_workers=COSPEND.concurrency) as executor:
+        futures = [executor.submit(create_bill, payment) for payment in state.approved]
+        # report every bill, so it is clear which ones exist even if some failed
+        for payment, future in zip(state.approved, futures):
+            print("create_bill", payment.payee)
+            try:
+                response = future.result()
+            except requests.RequestException as e:
+                print("failed:", e)
+                failed.append(payment)
+                continue
+            if response.ok:
+                print(response.status_code, response.text)
+            else:
+                print("failed:", response.status_code, response.text)
+                failed.append(payment)
+    if failed:
+        print(f"{len(failed)} of {len(state.approved)} bills could not be created:")
+        for payment in failed:
+            print(f"  {payment.date.isoformat()} {payment.payee_friendly}")